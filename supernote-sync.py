@@ -1,26 +1,17 @@
 """Keep syncing (one-way) supernote data via local browsing URL to provided
 directory.
-
-Usage:
-  supernote-sync.py <output-dir> [--url=<url>] [--no-conversion]
-  supernote-sync.py watch <output-dir> [--url=<url>] [--no-conversion] [--cooldown-interval=<cooldown-interval>]
-
-Options:
-  --url=<url>                                Full URL for supernote web browsing tool. If this is not provided,
-                                             autodiscovery is attempted.
-  --no-conversion                            Don't do any PDF or other format-appropriate conversions after
-                                             downloading
-  --cooldown-interval=<cooldown-interval>    Time to wait, in minutes, before starting the continuous watcher
-                                             again. This should be high enough or Supernote won't shut down the
-                                             server and will keep draining the battery. [default: 120]
 """
 
-from docopt import docopt
+import argparse
 import aiohttp
 import aiofiles
 import asyncio
+import email.utils
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import re
+import shutil
 import json
+import multiprocessing
 import os
 from loguru import logger
 import networkscan
@@ -31,10 +22,26 @@ import time
 
 __version__ = "0.3.0"
 
+# Sidecar file in the output directory keeping metadata of synced files
+MANIFEST_FILENAME = ".supernote-sync.json"
+
+# Directory listing pages embed the file list as a JSON string literal
+_LISTING_RE = re.compile(rb"const json = '(.*?)'")
+
+
+async def is_port_open(host: str, port: int, timeout: float = 1) -> bool:
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+    writer.close()
+    return True
+
 
-async def is_supernote_url(session: aiohttp.ClientSession, url: str) -> bool:
+async def is_supernote_url(session: aiohttp.ClientSession, url: str, timeout: float = 5) -> bool:
     try:
-        await read_directory(session, url)
+        await asyncio.wait_for(read_directory(session, url), timeout=timeout)
         return True
     except Exception:
         return False
@@ -44,47 +51,216 @@ async def discover_supernote(hosts: list[str]) -> str:
     """Discover Supernote with local browsing enabled on the network.
 
     We assume the server has opened 8089 port, on which we do a simple
-    validation.
+    validation. Hosts without the port open are filtered out with a short TCP
+    probe first. The remaining ones get a few seconds to serve their listing,
+    and we return on the first host that validates.
     """
 
     logger.debug(f"Scanning {len(hosts)} hosts: {hosts}")
 
-    async with aiohttp.ClientSession() as session:
-        port = 8089
-        tasks = [is_supernote_url(session, f"http://{host}:{port}") for host in hosts]
+    port = 8089
+    limit = 64
+    semaphore = asyncio.Semaphore(limit)
+
+    async def _probe(host: str) -> str | None:
+        async with semaphore:
+            if await is_port_open(host, port) and await is_supernote_url(session, f"http://{host}:{port}"):
+                return host
+            return None
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit)) as session:
+        tasks = [asyncio.create_task(_probe(host)) for host in hosts]
+
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                host = await next_result
+                if host:
+                    return f"http://{host}:{port}"
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    raise RuntimeError("Supernote was not found on the network")
 
-        results = await asyncio.gather(*tasks)
 
-    idx, result = max(enumerate(results), key=lambda it: it[1])
+def _convert_sync(input_path: str, output_path: str):
+    """Synchronous .note to .pdf conversion. This is module level so that it can
+    be shipped to a worker process.
+    """
 
-    if result is False:
-        raise RuntimeError("Supernote was not found on the network")
+    notebook = sn.load_notebook(input_path, policy="strict")
+    converter = PdfConverter(notebook, palette=None)
+    data = converter.convert(-1, vectorize=False, enable_link=True, enable_keyword=True)
 
-    return f"http://{hosts[idx]}:{port}"
+    with open(output_path, "wb") as fp:
+        fp.write(data)
 
 
-async def convert_to_pdf(input_path: str, output_path: str):
+async def convert_to_pdf(executor: ProcessPoolExecutor, input_path: str, output_path: str):
     """Convert input .note file to output .pdf file.
+
+    Conversion is CPU bound and holds the GIL so this runs in the provided
+    process pool, letting multiple notes convert in parallel while downloads go
+    on.
+    """
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(executor, _convert_sync, input_path, output_path)
+
+
+async def convert_to_pdf_rust(executor: ProcessPoolExecutor, input_path: str, output_path: str):
+    """Convert input .note file to output .pdf file using the supernote-pdf
+    binary.
+
+    This runs as a separate process so the executor is not needed.
+    """
+
+    proc = await asyncio.create_subprocess_exec(
+        "supernote-pdf", input_path, "-o", output_path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await proc.communicate()
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"supernote-pdf failed for {input_path}: {stderr.decode().strip()}")
+
+
+def is_up_to_date(input_path: str, output_path: str) -> bool:
+    """Tell if output_path was converted from the current input_path.
+
+    Converted outputs are stamped with the mtime of their source, so this is an
+    equality check and never compares the device clock with the local one.
+    """
+
+    return os.path.exists(output_path) and os.path.getmtime(output_path) == os.path.getmtime(input_path)
+
+
+# Mapping from downloaded file extension to the extension of converted output
+# and the converter coroutine producing it
+CONVERTERS = {
+    ".note": (".pdf", convert_to_pdf)
+}
+
+
+async def download_file(session: aiohttp.ClientSession, url: str, output_path: str) -> dict:
+    """Download file at url to output_path using the shared session and return
+    validators (Content-Length, Last-Modified) from the response.
+
+    Supernote links don't really stream so chunk size doesn't matter much, but
+    going through the session lets us reuse keep-alive connections instead of
+    spawning a process and doing a fresh handshake per file.
     """
 
-    loop = asyncio.get_event_loop()
+    # Writing to a temporary file in the same directory first so that an
+    # interrupted download never leaves a truncated file at output_path
+    tmp_path = os.path.join(os.path.dirname(output_path), f".{os.path.basename(output_path)}.part")
+
+    try:
+        async with session.get(url) as response:
+            response.raise_for_status()
+
+            async with aiofiles.open(tmp_path, "wb") as fp:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    await fp.write(chunk)
 
-    def _convert(input_path: str):
-        notebook = sn.load_notebook(input_path, policy="strict")
-        converter = PdfConverter(notebook, palette=None)
-        return converter.convert(-1, vectorize=False, enable_link=True, enable_keyword=True)
+            validators = {
+                "content_length": response.headers.get("Content-Length"),
+                "last_modified": response.headers.get("Last-Modified")
+            }
+
+        # Local mtime mirrors the server's Last-Modified
+        if validators["last_modified"]:
+            try:
+                mtime = email.utils.parsedate_to_datetime(validators["last_modified"]).timestamp()
+                os.utime(tmp_path, (mtime, mtime))
+            except (TypeError, ValueError):
+                pass
+
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return validators
+
+
+def load_manifest(output_dir: str) -> dict:
+    """Load metadata of files synced in earlier runs, keyed by uri."""
+
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILENAME)) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(output_dir: str, manifest: dict):
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    tmp_path = manifest_path + ".part"
+
+    # Replacing in one go so that an interrupted write doesn't lose the
+    # manifest and force a full re-sync
+    try:
+        with open(tmp_path, "w") as fp:
+            json.dump(manifest, fp)
+        os.replace(tmp_path, manifest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-    data = await loop.run_in_executor(None, _convert, input_path)
 
-    async with aiofiles.open(output_path, "wb") as fp:
-        await fp.write(data)
+def listing_metadata(item: dict) -> dict:
+    """Return the bits of a listing item that change when the item changes."""
 
+    return {k: item.get(k) for k in ("size", "date")}
 
-async def download_file(url: str, output_path: str):
-    # Supernote links don't allow streaming downloads so we can't do much beyond
-    # what wget can do.
-    proc = await asyncio.create_subprocess_exec("wget", "-O", output_path, url, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-    await proc.communicate()
+
+async def is_unchanged(session: aiohttp.ClientSession, url: str, filepath: str, item: dict, entry: dict | None) -> bool:
+    """Tell if local filepath is already up to date with the item on supernote.
+
+    Only a local file that still matches what we recorded at its last download
+    can be up to date. When the listing metadata matches the record too, no
+    request is made. Otherwise a HEAD with the recorded Last-Modified as
+    If-Modified-Since is sent and the response validators are compared with
+    the recorded ones.
+    """
+
+    if not os.path.exists(filepath):
+        return False
+
+    stat = os.stat(filepath)
+
+    try:
+        if item.get("size") is not None and int(item["size"]) != stat.st_size:
+            return False
+    except (TypeError, ValueError):
+        pass
+
+    local_intact = entry is not None and entry["local_size"] == stat.st_size and entry["local_mtime"] == stat.st_mtime
+    if not local_intact:
+        return False
+
+    listing = listing_metadata(item)
+    if any(listing.values()) and entry["listing"] == listing:
+        return True
+
+    headers = {"If-Modified-Since": entry["last_modified"]} if entry["last_modified"] else {}
+    async with session.head(url, headers=headers) as response:
+        if response.status == 304:
+            return True
+
+        if response.status == 200:
+            content_length = response.headers.get("Content-Length")
+            last_modified = response.headers.get("Last-Modified")
+            if content_length and last_modified:
+                return (content_length, last_modified) == (entry["content_length"], entry["last_modified"])
+
+    return False
 
 
 async def read_directory(session: aiohttp.ClientSession, url: str) -> list[dict]:
@@ -93,88 +269,265 @@ async def read_directory(session: aiohttp.ClientSession, url: str) -> list[dict]
     """
 
     async with session.get(url) as response:
-        html = await response.text()
-        data = None
+        body = await response.read()
+
+    match = _LISTING_RE.search(body)
+    data = json.loads(match.group(1)) if match else None
+
+    if not data:
+        raise RuntimeError(f"Unable to parse {url}")
+
+    return data["fileList"]
+
+
+async def list_files(session: aiohttp.ClientSession, root_url: str, manifest: dict, reuse_listings: bool) -> list[dict]:
+    """Walk the supernote tree and return all file items.
+
+    The tree is walked level by level with all directories of a level listed
+    concurrently, so this takes as many round trips as the tree is deep.
+    Directories that can't be listed are logged and skipped.
+    Listings are recorded in the manifest and, with reuse_listings, directories
+    whose listing metadata hasn't changed are not read again.
+    """
+
+    files = []
+    items = await read_directory(session, root_url)
+
+    while items:
+        files.extend(it for it in items if not it["isDirectory"])
+
+        cached, dirs = [], []
+        for it in (it for it in items if it["isDirectory"]):
+            entry = manifest.get(it["uri"])
+            listing = listing_metadata(it)
+            if reuse_listings and entry and "children" in entry and any(listing.values()) and entry["listing"] == listing:
+                cached.extend(entry["children"])
+            else:
+                dirs.append(it)
+
+        # A failed directory is logged and left out of this sync, the same way
+        # file errors are handled
+        results = await asyncio.gather(*[read_directory(session, root_url + it["uri"]) for it in dirs], return_exceptions=True)
+        listings = []
+        for it, result in zip(dirs, results):
+            if isinstance(result, Exception):
+                logger.error(f"Unable to list {it['uri']}: {result}")
+                continue
 
-        for line in html.splitlines():
-            match = re.search(r"const json = '(.*?)'", line)
-            if match:
-                data = json.loads(match.groups()[0])
-                break
+            manifest[it["uri"]] = {"listing": listing_metadata(it), "children": result}
+            listings.append(result)
 
-        if not data:
-            raise RuntimeError(f"Unable to parse {url}")
+        items = cached + [it for listing in listings for it in listing]
 
-        return data["fileList"]
+    return files
 
 
-async def worker(q, session, root_url, semaphore, output_dir, should_convert: bool):
+async def worker(q, convert_q, session, root_url, semaphore, output_dir, should_convert: bool, manifest: dict, stats: dict, created_dirs: set[str]):
     while True:
         item = await q.get()
-        item_url = root_url + item["uri"]
-        parent_dir = os.path.abspath(os.path.join(output_dir + item["uri"], os.pardir))
-        os.makedirs(parent_dir, exist_ok=True)
+        try:
+            item_url = root_url + item["uri"]
+            parent_dir = os.path.abspath(os.path.join(output_dir, os.path.dirname(item["uri"]).lstrip("/")))
+            if parent_dir not in created_dirs:
+                os.makedirs(parent_dir, exist_ok=True)
+                created_dirs.add(parent_dir)
 
-        if item["isDirectory"]:
-            for it in await read_directory(session, item_url):
-                await q.put(it)
-        else:
-            async with semaphore:
-                filepath = os.path.join(parent_dir, item["name"])
-                await download_file(item_url, filepath)
-                logger.info(f"Downloaded {item['name']} to {filepath}")
+            filepath = os.path.join(parent_dir, item["name"])
 
-                if should_convert and filepath.endswith(".note"):
-                    pdf_filepath = os.path.splitext(filepath)[0] + ".pdf"
-                    await convert_to_pdf(filepath, pdf_filepath)
-                    logger.info(f"Converted {item['name']} to pdf")
+            async with semaphore:
+                unchanged = await is_unchanged(session, item_url, filepath, item, manifest.get(item["uri"]))
+                if not unchanged:
+                    validators = await download_file(session, item_url, filepath)
+                    logger.info(f"Downloaded {item['name']} to {filepath}")
+
+            if unchanged:
+                stats["skipped"] += 1
+                logger.debug(f"Skipping unchanged {item['name']}")
+            else:
+                stat = os.stat(filepath)
+                stats["downloaded"] += 1
+                stats["bytes_in"] += stat.st_size
+                manifest[item["uri"]] = {
+                    "listing": listing_metadata(item),
+                    "local_size": stat.st_size,
+                    "local_mtime": stat.st_mtime,
+                    **validators
+                }
+
+            # Conversion is handed off to conversion workers so that downloads
+            # aren't gated on conversion
+            root, ext = os.path.splitext(filepath)
+            if should_convert and ext in CONVERTERS:
+                output_ext, converter = CONVERTERS[ext]
+                output_filepath = root + output_ext
+                if not unchanged or not is_up_to_date(filepath, output_filepath):
+                    await convert_q.put((converter, filepath, output_filepath))
+        except Exception as e:
+            logger.error(f"Unable to sync {item['name']}: {e}")
+        finally:
+            q.task_done()
+
+
+async def conversion_worker(convert_q, executor: ProcessPoolExecutor, stats: dict):
+    while True:
+        converter, filepath, output_filepath = await convert_q.get()
+        try:
+            source_mtime = os.path.getmtime(filepath)
+            await converter(executor, filepath, output_filepath)
+            os.utime(output_filepath, (source_mtime, source_mtime))
+            stats["converted"] += 1
+            logger.info(f"Converted {os.path.basename(filepath)} to {os.path.basename(output_filepath)}")
+        except Exception as e:
+            logger.error(f"Unable to convert {os.path.basename(filepath)}: {e}")
 
-        q.task_done()
+        convert_q.task_done()
 
 
-async def supernote_to_local(session: aiohttp.ClientSession, root_url: str, output_dir: str, should_convert: bool):
-    """Run supernote to local sync. This unconditionally downloads the
-    supernote tree structure to the local directory.
+async def supernote_to_local(session: aiohttp.ClientSession, root_url: str, output_dir: str, should_convert: bool, executor: ProcessPoolExecutor, n: int, reuse_listings: bool):
+    """Run supernote to local sync. This downloads the supernote tree structure
+    to the local directory, skipping files that haven't changed since the last
+    sync.
 
     This overrides files with same name and path in local but doesn't delete
     anything else that might be present in local.
+
+    Return counts of downloaded, skipped and converted files along with bytes
+    downloaded.
     """
 
-    n = 5
+    m = os.cpu_count() or 1
     q = asyncio.Queue()
+    convert_q = asyncio.Queue()
     semaphore = asyncio.Semaphore(n)
+    manifest = load_manifest(output_dir)
+    stats = {"downloaded": 0, "skipped": 0, "converted": 0, "bytes_in": 0}
+    created_dirs = set()
 
-    for it in await read_directory(session, root_url):
-        await q.put(it)
+    for it in await list_files(session, root_url, manifest, reuse_listings):
+        q.put_nowait(it)
 
     tasks = []
     for _ in range(n):
-        task = asyncio.create_task(worker(q, session, root_url, semaphore, output_dir, should_convert))
+        task = asyncio.create_task(worker(q, convert_q, session, root_url, semaphore, output_dir, should_convert, manifest, stats, created_dirs))
+        tasks.append(task)
+
+    for _ in range(m):
+        task = asyncio.create_task(conversion_worker(convert_q, executor, stats))
         tasks.append(task)
 
+    # All conversions are queued by the time downloads are done
     await q.join()
+    await convert_q.join()
+    save_manifest(output_dir, manifest)
 
     for task in tasks:
         task.cancel()
 
+    return stats
 
-async def main(root_url: str, output_dir: str, should_convert: bool):
-    async with aiohttp.ClientSession() as session:
-        try:
-            await supernote_to_local(session, root_url, output_dir, should_convert)
-        except aiohttp.client_exceptions.ClientConnectorError:
-            logger.error("Can't connect to supernote")
 
+def next_cooldown_interval(current: int, changed_count: int, min_interval: int, max_interval: int) -> int:
+    """Back off exponentially while nothing changes on supernote and snap back
+    to the minimum interval once something does.
+    """
 
-if __name__ == "__main__":
-    args = docopt(__doc__, version=__version__)
+    if changed_count > 0:
+        return min_interval
 
-    output_dir = args["<output-dir>"]
-    should_convert = not args["--no-conversion"]
-    root_url = args["--url"]
+    return max(min_interval, min(max_interval, current * 2))
+
+
+async def main(root_url: str, output_dir: str, should_convert: bool, concurrency: int, reuse_listings: bool) -> int | None:
+    """Sync once, log metrics of the sync and return the number of files that
+    changed, or None if the sync failed.
+
+    The connection pool is sized to match download concurrency so that no
+    worker waits on a free connection. File writes from aiofiles and DNS
+    lookups go to the loop's default executor, which is replaced by a thread
+    pool of the same size, while conversions get their own process pool.
+    """
+
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="supernote-io"))
+
+    connector = aiohttp.TCPConnector(
+        limit=concurrency,
+        limit_per_host=concurrency,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True,
+        # Supernote sits on the LAN with a stable address, resolving it once per
+        # run is enough
+        use_dns_cache=True,
+        ttl_dns_cache=3600
+    )
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+
+    # Not forking since the loop's thread pool is already running by the time
+    # conversions are submitted
+    mp_context = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=mp_context) as executor:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            try:
+                stats = await supernote_to_local(session, root_url, output_dir, should_convert, executor, concurrency, reuse_listings)
+            except aiohttp.client_exceptions.ClientConnectorError:
+                logger.error("Can't connect to supernote")
+                return None
+
+    logger.info(
+        f"Sync done: {stats['downloaded']} downloaded ({stats['bytes_in']} bytes), "
+        f"{stats['skipped']} skipped, {stats['converted']} converted"
+    )
+    return stats["downloaded"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", nargs="?", choices=["watch"],
+                        help="Watch the local network for supernote and keep syncing")
+    parser.add_argument("output_dir", metavar="output-dir")
+    parser.add_argument("--url",
+                        help="Full URL for supernote web browsing tool. If this is not provided, autodiscovery is attempted.")
+    parser.add_argument("--no-conversion", action="store_true",
+                        help="Don't do any PDF or other format-appropriate conversions after downloading")
+    parser.add_argument("--converter", choices=["python", "rust"], default="python",
+                        help=("Converter for .note to PDF, either python (supernotelib) or rust (supernote-pdf binary "
+                              "on PATH). Falls back to python if the binary is not found. (default: %(default)s)"))
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="Number of files to download in parallel. (default: %(default)s)")
+    parser.add_argument("--reuse-listings", action="store_true",
+                        help=("Don't walk into directories whose date and size are the same as in the last sync and "
+                              "reuse their recorded listings instead. Only safe if Supernote updates directory dates "
+                              "when anything beneath changes."))
+    parser.add_argument("--cooldown-interval", type=int, default=120,
+                        help=("Time to wait, in minutes, before starting the continuous watcher again. This should be "
+                              "high enough or Supernote won't shut down the server and will keep draining the "
+                              "battery. (default: %(default)s)"))
+    parser.add_argument("--max-cooldown-interval", type=int, default=960,
+                        help=("Upper bound, in minutes, for the wait between syncs. The wait doubles after every sync "
+                              "with no changes till it reaches this and drops back to --cooldown-interval as soon as "
+                              "a sync finds changes. (default: %(default)s)"))
+    parser.add_argument("--version", action="version", version=__version__)
+    args = parser.parse_args()
+
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+
+    output_dir = args.output_dir
+    should_convert = not args.no_conversion
+    root_url = args.url
+    concurrency = args.concurrency
+    reuse_listings = args.reuse_listings
+
+    if args.converter == "rust":
+        if shutil.which("supernote-pdf"):
+            CONVERTERS[".note"] = (".pdf", convert_to_pdf_rust)
+        else:
+            logger.warning("supernote-pdf not found on PATH, falling back to python converter")
 
-    if args["watch"]:
-        cooldown_interval = int(args["--cooldown-interval"])
+    if args.command == "watch":
+        min_cooldown_interval = args.cooldown_interval
+        max_cooldown_interval = args.max_cooldown_interval
+        cooldown_interval = min_cooldown_interval
         while True:
             time.sleep(1)
             logger.info("Auto discovering Supernote on the network")
@@ -185,7 +538,9 @@ if __name__ == "__main__":
             try:
                 root_url = asyncio.run(discover_supernote(scan.list_of_hosts_found))
                 logger.info(f"Supernote found at {root_url}")
-                asyncio.run(main(root_url, output_dir, should_convert))
+                changed_count = asyncio.run(main(root_url, output_dir, should_convert, concurrency, reuse_listings))
+                if changed_count is not None:
+                    cooldown_interval = next_cooldown_interval(cooldown_interval, changed_count, min_cooldown_interval, max_cooldown_interval)
                 logger.info(f"Waiting for {cooldown_interval} minutes before next sync")
                 time.sleep(cooldown_interval * 60)
             except Exception:
@@ -201,4 +556,4 @@ if __name__ == "__main__":
             root_url = asyncio.run(discover_supernote(scan.list_of_hosts_found))
             logger.info(f"Supernote found at {root_url}")
 
-        asyncio.run(main(root_url, output_dir, should_convert))
+        asyncio.run(main(root_url, output_dir, should_convert, concurrency, reuse_listings))